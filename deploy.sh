@@ -114,6 +114,7 @@ gcloud run deploy credit-risk-portal \
   --platform managed \
   --region $REGION \
   --allow-unauthenticated \
+  --cpu-boost \
   --set-env-vars PROJECT_ID=$PROJECT_ID \
   --project $PROJECT_ID
 
@@ -1,9 +1,17 @@
+import time
+_IMPORT_STARTED = time.perf_counter()
+
 import os
 import logging
 import json
-from flask import Flask, render_template_string, request, jsonify
-from google.cloud import bigquery
-from google.cloud import storage
+import hashlib
+import math
+import sys
+import threading
+from flask import Flask, Response, request, jsonify
+
+import portfolio
+import serving
 
 # Configure Logging
 logging.basicConfig(level=logging.INFO)
@@ -14,10 +22,167 @@ app = Flask(__name__)
 PROJECT_ID = os.environ.get('PROJECT_ID')
 if not PROJECT_ID: raise ValueError("PROJECT_ID environment variable must be set.")
 
-bq_client = bigquery.Client(project=PROJECT_ID)
-storage_client = storage.Client(project=PROJECT_ID)
 BUCKET_NAME = f"{PROJECT_ID}-data"
 
+# =======================================================
+# LAZY GCP CLIENTS (Cold-Start Optimization)
+# =======================================================
+# The google-cloud libraries are the bulk of our import time, and building a
+# client resolves credentials. Neither is needed to serve the static page, so
+# both are deferred until the first request that actually talks to GCP (or
+# built at import time when WARMUP_ON_START is set).
+_clients = {}
+_clients_lock = threading.Lock()
+
+def get_bq_client():
+    client = _clients.get('bigquery')
+    if client is None:
+        with _clients_lock:
+            client = _clients.get('bigquery')
+            if client is None:
+                from google.cloud import bigquery
+                client = _clients['bigquery'] = bigquery.Client(project=PROJECT_ID)
+    return client
+
+def get_storage_client():
+    client = _clients.get('storage')
+    if client is None:
+        with _clients_lock:
+            client = _clients.get('storage')
+            if client is None:
+                from google.cloud import storage
+                client = _clients['storage'] = storage.Client(project=PROJECT_ID)
+    return client
+
+def reset_clients():
+    """Drops any clients inherited across a fork (their sockets are not fork-safe)."""
+    with _clients_lock:
+        _clients.clear()
+
+def load_serving_state():
+    """Loads model coefficients and profiles into memory (gunicorn master, before fork)."""
+    global _model_pinned, _model_checked_at, _profiles_pinned, _profiles_checked_at
+    # Test-only: serve a fixed snapshot (loadtest.py). Its coefficients are never
+    # checked against ML.PREDICT, so it needs an explicit opt-in.
+    snapshot = os.environ.get('SERVING_STATE_PATH')
+    if snapshot:
+        if os.environ.get('ALLOW_UNVERIFIED_SNAPSHOT', '').lower() not in ('1', 'true', 'yes'):
+            logger.error("SERVING_STATE_PATH is ignored without ALLOW_UNVERIFIED_SNAPSHOT=true (test use only)")
+        else:
+            logger.warning(f"Serving unverified snapshot {snapshot}: test use only, never in production")
+            serving.load_snapshot(snapshot)
+            _model_pinned = _profiles_pinned = True
+            return True
+    from google.cloud import bigquery
+    # A throwaway client: the master must not hand open connections to workers.
+    client = bigquery.Client(project=PROJECT_ID)
+    try:
+        include_profiles = os.environ.get('PRELOAD_PROFILES', '').lower() in ('1', 'true', 'yes')
+        loaded = serving.load_state(client, PROJECT_ID, include_profiles=include_profiles)
+        if loaded:
+            _model_checked_at = _profiles_checked_at = time.monotonic()
+        return loaded
+    finally:
+        client.close()
+
+profile_cache = serving.ProfileCache(PROJECT_ID, ttl_seconds=int(os.environ.get('PROFILE_CACHE_TTL', 300)),
+                                     max_rows=int(os.environ.get('PROFILE_CACHE_MAX_ROWS', 100000)))
+
+# =======================================================
+# PRELOADED PROFILE FRESHNESS
+# =======================================================
+# The preloaded ProfileStore is a point-in-time copy of credit_history. Each
+# worker re-checks the table version (a metadata call) at most every
+# PROFILE_VERSION_CHECK_SECONDS. Once the table has changed, the worker drops
+# the snapshot and reads live through the cache/BigQuery again. It does not
+# reload the snapshot itself, which would give every worker a private copy.
+PROFILE_VERSION_CHECK_SECONDS = int(os.environ.get('PROFILE_VERSION_CHECK_SECONDS', 300))
+_profiles_lock = threading.Lock()
+_profiles_checked_at = float('-inf')
+_profiles_pinned = False
+
+def current_profiles():
+    """The preloaded serving.ProfileStore while it is still current (possibly empty)."""
+    global _profiles_checked_at
+    store = serving.PROFILES
+    if _profiles_pinned or not len(store) or PROFILE_VERSION_CHECK_SECONDS <= 0:
+        return store
+    if time.monotonic() - _profiles_checked_at < PROFILE_VERSION_CHECK_SECONDS:
+        return store
+    if not _profiles_lock.acquire(blocking=False):
+        return store
+    try:
+        _profiles_checked_at = time.monotonic()
+        version = serving.fetch_profiles_version(get_bq_client(), PROJECT_ID)
+        if version != store.version:
+            logger.info("credit_history changed since preload; switching to live profile lookups")
+            serving.PROFILES = serving.ProfileStore()
+    except Exception as e:
+        logger.warning(f"Profile version check failed, keeping preloaded profiles: {e}")
+    finally:
+        _profiles_lock.release()
+    return serving.PROFILES
+
+# =======================================================
+# MODEL VERSION TRACKING
+# =======================================================
+# Coefficients, feature means and global attributions are fetched once per
+# model version. Each worker re-checks the version (a metadata call, not a
+# query job) at most every MODEL_VERSION_CHECK_SECONDS; 0 pins the state.
+# Coefficients that fail the ML.PREDICT parity check are kept unverified: they
+# never score or explain, but the version is remembered (so it is not
+# re-fetched until the model changes) and its global explanation is served.
+#
+# LOCAL_SCORING (default: true) lets verified coefficients make /process-loan
+# decisions in-process. With it off, decisions always come from ML.PREDICT
+# and the coefficients are only used for explanations.
+LOCAL_SCORING = os.environ.get('LOCAL_SCORING', 'true').lower() in ('1', 'true', 'yes')
+MODEL_VERSION_CHECK_SECONDS = int(os.environ.get('MODEL_VERSION_CHECK_SECONDS', 300))
+_model_lock = threading.Lock()
+_model_checked_at = float('-inf')
+_model_pinned = False
+
+def current_model():
+    """
+    The serving.ModelState for the live model version, or None if it cannot be
+    loaded. Check `verified` before scoring with it.
+    """
+    global _model_checked_at
+    if _model_pinned or (MODEL_VERSION_CHECK_SECONDS <= 0 and serving.MODEL is not None):
+        return serving.MODEL
+    if time.monotonic() - _model_checked_at < MODEL_VERSION_CHECK_SECONDS:
+        return serving.MODEL
+    # Only block if there is nothing to serve yet; otherwise let one thread refresh.
+    if not _model_lock.acquire(blocking=serving.MODEL is None):
+        return serving.MODEL
+    try:
+        if time.monotonic() - _model_checked_at >= MODEL_VERSION_CHECK_SECONDS:
+            _model_checked_at = time.monotonic()
+            client = get_bq_client()
+            version = serving.fetch_model_version(client, PROJECT_ID)
+            if serving.MODEL is None or serving.MODEL.version != version:
+                try:
+                    serving.MODEL = serving.fetch_model_state(client, PROJECT_ID, version)
+                except Exception:
+                    # The coefficients we hold belong to a model that has been replaced.
+                    serving.MODEL = None
+                    raise
+                logger.info(f"Model state loaded for version {version} (verified: {serving.MODEL.verified})")
+    except Exception as e:
+        logger.warning(f"Model state refresh failed, keeping current state: {e}")
+    finally:
+        _model_lock.release()
+    return serving.MODEL
+
+def warm_up():
+    """Builds both GCP clients ahead of the first real request."""
+    started = time.perf_counter()
+    get_bq_client()
+    get_storage_client()
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    STARTUP_STATS['warmup_ms'] = round(elapsed_ms, 2)
+    logger.info(f"Warm-up complete in {elapsed_ms:.1f} ms")
+
 HTML_TEMPLATE = """
 <!DOCTYPE html>
 <html>
@@ -194,14 +359,86 @@ HTML_TEMPLATE = """
 </html>
 """
 
+# The page has no template variables, so it is rendered once at import time
+# and served as static bytes with validators the browser/CDN can cache on.
+HOME_PAGE = HTML_TEMPLATE.encode('utf-8')
+HOME_PAGE_ETAG = hashlib.sha256(HOME_PAGE).hexdigest()[:16]
+HOME_PAGE_MAX_AGE = int(os.environ.get('HOME_PAGE_MAX_AGE', 300))
+
+# =======================================================
+# STARTUP PROFILER
+# =======================================================
+# import_ms: module import (measured from the first line of this file).
+# ready_ms: process start to ready-to-serve. Under gunicorn this is measured
+#   from the master's start to the end of this worker's boot (incl. warm-up).
+# first_request_ms: the first request that does real work, i.e. not the
+#   static page or the startup probe itself.
+# first_call_ms: first-call latency per endpoint (same exclusions).
+# warmup_ms: client construction, when WARMUP_ON_START is set.
+STARTUP_STATS = {'import_ms': None, 'ready_ms': None, 'first_request_ms': None,
+                 'first_call_ms': {}, 'warmup_ms': None}
+STARTUP_EXCLUDED_ENDPOINTS = {'home', 'startup_stats', 'static'}
+_first_request_lock = threading.Lock()
+
+def _process_age_seconds(pid):
+    """Seconds since `pid` started (from /proc), or None where /proc is unavailable."""
+    try:
+        with open(f'/proc/{pid}/stat') as f:
+            # The command name (field 2) may contain spaces; starttime is field 22.
+            start_ticks = int(f.read().rsplit(')', 1)[1].split()[19])
+        with open('/proc/uptime') as f:
+            uptime = float(f.read().split()[0])
+        return uptime - start_ticks / os.sysconf('SC_CLK_TCK')
+    except (OSError, ValueError, IndexError):
+        return None
+
+def mark_ready(pid=None):
+    """Records ready_ms for the process `pid` (default: this one) once this process can serve."""
+    age = _process_age_seconds(pid or os.getpid())
+    if age is None:
+        age = time.perf_counter() - _IMPORT_STARTED
+    STARTUP_STATS['ready_ms'] = round(age * 1000, 2)
+    logger.info(f"Ready to serve {STARTUP_STATS['ready_ms']:.1f} ms after process start")
+
+@app.before_request
+def _start_request_timer():
+    request.environ['risk_engine.started'] = time.perf_counter()
+
+@app.after_request
+def _record_first_request(response):
+    endpoint = request.endpoint
+    # Unmatched routes (None) and the probe/static paths say nothing about a cold GCP path.
+    if endpoint is None or endpoint in STARTUP_EXCLUDED_ENDPOINTS or endpoint in STARTUP_STATS['first_call_ms']:
+        return response
+    with _first_request_lock:
+        if endpoint not in STARTUP_STATS['first_call_ms']:
+            started = request.environ.get('risk_engine.started', time.perf_counter())
+            elapsed_ms = round((time.perf_counter() - started) * 1000, 2)
+            STARTUP_STATS['first_call_ms'][endpoint] = elapsed_ms
+            if STARTUP_STATS['first_request_ms'] is None:
+                STARTUP_STATS['first_request_ms'] = elapsed_ms
+            logger.info(f"First call to {request.path} served in {elapsed_ms:.1f} ms")
+    return response
+
 @app.route('/')
 def home():
-    return render_template_string(HTML_TEMPLATE)
+    if request.if_none_match.contains(HOME_PAGE_ETAG):
+        response = Response(status=304)
+    else:
+        response = Response(HOME_PAGE, mimetype='text/html')
+    response.set_etag(HOME_PAGE_ETAG)
+    response.cache_control.public = True
+    response.cache_control.max_age = HOME_PAGE_MAX_AGE
+    return response
+
+@app.route('/startup-stats', methods=['GET'])
+def startup_stats():
+    return jsonify(STARTUP_STATS)
 
 @app.route('/list-applications', methods=['GET'])
 def list_apps():
     try:
-        bucket = storage_client.bucket(BUCKET_NAME)
+        bucket = get_storage_client().bucket(BUCKET_NAME)
         blobs = bucket.list_blobs(prefix="applications/")
         files = sorted([b.name for b in blobs if b.name.endswith('.json')])
         return jsonify(files) 
@@ -211,71 +448,244 @@ def list_apps():
 def get_app():
     filename = request.args.get('file')
     try:
-        bucket = storage_client.bucket(BUCKET_NAME)
+        bucket = get_storage_client().bucket(BUCKET_NAME)
         blob = bucket.blob(filename)
         data = json.loads(blob.download_as_string())
         return jsonify(data)
     except Exception as e: return jsonify({'error': str(e)}), 500
 
+def fetch_profile(cust_id):
+    """Profile features (serving.PROFILE_FEATURES order), or None for a net-new customer."""
+    # 1. Pre-fork snapshot (PRELOAD_PROFILES)
+    profile = current_profiles().get(cust_id)
+    if profile is not None:
+        return profile
+
+    # 2. Host-wide cache shared by all workers
+    try:
+        return profile_cache.get(cust_id)
+    except KeyError:
+        pass
+
+    # 3. BigQuery (System of Record)
+    from google.cloud import bigquery
+    profile_query = f"""
+        SELECT {', '.join(serving.PROFILE_FEATURES)}
+        FROM `{PROJECT_ID}.credit_risk_mvp.credit_history`
+        WHERE customer_id = @customer_id LIMIT 1
+    """
+    job_config = bigquery.QueryJobConfig(query_parameters=[
+        bigquery.ScalarQueryParameter('customer_id', 'STRING', cust_id)])
+    rows = list(get_bq_client().query(profile_query, job_config=job_config).result())
+    profile = tuple(float(rows[0][f]) for f in serving.PROFILE_FEATURES) if rows else None
+    profile_cache.set(cust_id, profile)
+    return profile
+
+def fetch_profiles_bulk(cust_ids):
+    """fetch_profile() for many customers, with one BigQuery job for everything not in memory or cache."""
+    profiles, missing = {}, []
+    store = current_profiles()
+    for cust_id in cust_ids:
+        if cust_id in profiles:
+            continue
+        profile = store.get(cust_id)
+        if profile is None:
+            try:
+                profile = profile_cache.get(cust_id)
+            except KeyError:
+                missing.append(cust_id)
+                continue
+        profiles[cust_id] = profile
+
+    missing = list(dict.fromkeys(missing))
+    if missing:
+        from google.cloud import bigquery
+        profile_query = f"""
+            SELECT customer_id, {', '.join(serving.PROFILE_FEATURES)}
+            FROM `{PROJECT_ID}.credit_risk_mvp.credit_history`
+            WHERE customer_id IN UNNEST(@customer_ids)
+        """
+        job_config = bigquery.QueryJobConfig(query_parameters=[
+            bigquery.ArrayQueryParameter('customer_ids', 'STRING', missing)])
+        found = {str(row.customer_id): tuple(float(row[f]) for f in serving.PROFILE_FEATURES)
+                 for row in get_bq_client().query(profile_query, job_config=job_config).result()}
+        for cust_id in missing:
+            profiles[cust_id] = found.get(cust_id)
+            profile_cache.set(cust_id, profiles[cust_id])
+    return profiles
+
+def _label_confidence(pred_row):
+    """(predicted_label, confidence) from an ML.PREDICT output row."""
+    confidence = 0.0
+    for p in pred_row.predicted_label_probs:
+        label = p['label'] if isinstance(p, dict) else p.label
+        prob = p['prob'] if isinstance(p, dict) else p.prob
+        if label == pred_row.predicted_label:
+            confidence = prob
+    return int(pred_row.predicted_label), confidence
+
+def predict_bigquery(profile, new_loan):
+    """Scores one application with ML.PREDICT; returns (predicted_label, confidence)."""
+    features = serving.profile_to_dict(profile)
+    predict_query = f"""
+        SELECT * FROM ML.PREDICT(
+            MODEL `{PROJECT_ID}.credit_risk_mvp.risk_score_model`,
+            (SELECT 
+                {features['age']} AS age,
+                {features['income']} AS income,
+                {new_loan} AS loan_amount,
+                {features['credit_score']} AS credit_score,
+                {features['months_employed']} AS months_employed,
+                {features['num_credit_lines']} AS num_credit_lines,
+                {features['interest_rate']} AS interest_rate,
+                {features['dti_ratio']} AS dti_ratio
+            )
+        )
+    """
+    pred_row = list(get_bq_client().query(predict_query).result())[0]
+    return _label_confidence(pred_row)
+
+def predict_bigquery_batch(items):
+    """predict_bigquery() for a list of (profile, loan_amount) pairs, in one ML.PREDICT job."""
+    if not items:
+        return []
+    rows = []
+    for i, (profile, loan_amount) in enumerate(items):
+        x = serving.feature_vector(profile, loan_amount)
+        rows.append(f"STRUCT({i} AS row_id, "
+                    f"{', '.join(f'{float(v)} AS {f}' for f, v in zip(serving.FEATURES, x))})")
+    predict_query = f"""
+        SELECT row_id, predicted_label, predicted_label_probs FROM ML.PREDICT(
+            MODEL `{PROJECT_ID}.credit_risk_mvp.risk_score_model`,
+            (SELECT * FROM UNNEST([{', '.join(rows)}]))
+        )
+    """
+    results = [None] * len(items)
+    for pred_row in get_bq_client().query(predict_query).result():
+        results[pred_row.row_id] = _label_confidence(pred_row)
+    return results
+
 @app.route('/process-loan', methods=['POST'])
 def process_loan():
     try:
         req = request.json
         cust_id = str(req.get('customer_id', '')).strip()
-        new_loan = req.get('loan_amount')
+        new_loan = float(req.get('loan_amount'))
         
         # 1. FETCH PROFILE
-        profile_query = f"""
-            SELECT * EXCEPT(customer_id, default_risk)
-            FROM `{PROJECT_ID}.credit_risk_mvp.credit_history`
-            WHERE customer_id = '{cust_id}' LIMIT 1
-        """
-        job = bq_client.query(profile_query)
-        rows = list(job.result())
+        profile = fetch_profile(cust_id)
         
         # HITL CHECK
-        if not rows:
+        if profile is None:
             return jsonify({
                 'prediction': 'HITL',
                 'probability': 0.0,
                 'message': 'Net New Customer'
             })
-            
-        profile = rows[0]
-        
-        # 2. RUN ML PREDICTION
-        predict_query = f"""
-            SELECT * FROM ML.PREDICT(
-                MODEL `{PROJECT_ID}.credit_risk_mvp.risk_score_model`,
-                (SELECT 
-                    {profile.age} AS age,
-                    {profile.income} AS income,
-                    {new_loan} AS loan_amount,
-                    {profile.credit_score} AS credit_score,
-                    {profile.months_employed} AS months_employed,
-                    {profile.num_credit_lines} AS num_credit_lines,
-                    {profile.interest_rate} AS interest_rate,
-                    {profile.dti_ratio} AS dti_ratio
-                )
-            )
-        """
-        pred_row = list(bq_client.query(predict_query).result())[0]
         
-        probs = pred_row.predicted_label_probs
-        confidence = 0.0
-        for p in probs:
-            label = p['label'] if isinstance(p, dict) else p.label
-            prob = p['prob'] if isinstance(p, dict) else p.prob
-            if label == pred_row.predicted_label:
-                confidence = prob
+        # 2. RUN PREDICTION (verified in-process coefficients when enabled, else BigQuery ML)
+        model = current_model()
+        if model is not None and model.verified and LOCAL_SCORING:
+            prediction, confidence = model.score(profile, new_loan)
+        else:
+            prediction, confidence = predict_bigquery(profile, new_loan)
+        explanation = model.explain(profile, new_loan) if model is not None else None
 
+        features = serving.profile_to_dict(profile)
         return jsonify({
-            'profile': {'income': profile.income, 'credit_score': profile.credit_score, 'months_employed': profile.months_employed},
-            'prediction': int(pred_row.predicted_label),
-            'probability': confidence
+            'profile': {'income': features['income'], 'credit_score': features['credit_score'], 'months_employed': features['months_employed']},
+            'prediction': prediction,
+            'probability': confidence,
+            'explanation': explanation
         })
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+MAX_EXPLAIN_BATCH = 1000
+
+@app.route('/explain/global', methods=['GET'])
+def explain_global():
+    model = current_model()
+    explanation = model.global_explanation() if model is not None else None
+    if explanation is None:
+        return jsonify({'error': 'Global explanation unavailable'}), 503
+    return jsonify(explanation)
+
+@app.route('/explain/batch', methods=['POST'])
+def explain_batch():
+    """
+    Decisions plus per-feature attributions for many applications. Decisions
+    follow the same rule as /process-loan: verified coefficients in-process
+    when LOCAL_SCORING is on, otherwise one batched ML.PREDICT job for the
+    whole request. Explanations are null while no verified model is loaded.
+    Body: {"applications": [{"customer_id": "...", "loan_amount": 25000}, ...]}
+    """
+    try:
+        apps = [(str(a.get('customer_id', '')).strip(), float(a.get('loan_amount')))
+                for a in (request.json or {}).get('applications') or []]
+    except (ValueError, TypeError, AttributeError) as e:
+        return jsonify({'error': str(e)}), 400
+    if len(apps) > MAX_EXPLAIN_BATCH:
+        return jsonify({'error': f"At most {MAX_EXPLAIN_BATCH} applications per request."}), 400
+    if not all(math.isfinite(loan) for _, loan in apps):
+        return jsonify({'error': 'loan_amount must be a finite number.'}), 400
+    if not apps:
+        return jsonify({'model_version': None, 'results': []})
+    try:
+        model = current_model()
+        profiles = fetch_profiles_bulk([cust_id for cust_id, _ in apps])
+        known = [(profiles[cust_id], loan) for cust_id, loan in apps if profiles[cust_id] is not None]
+        if model is not None and model.verified and LOCAL_SCORING:
+            decisions = [model.score(profile, loan) for profile, loan in known]
+        else:
+            decisions = predict_bigquery_batch(known)
+        explanations = model.explain_batch(known) if model is not None else [None] * len(known)
+        scored = iter(zip(decisions, explanations))
+
+        results = []
+        for cust_id, loan in apps:
+            if profiles[cust_id] is None:
+                results.append({'customer_id': cust_id, 'prediction': 'HITL', 'probability': 0.0,
+                                'message': 'Net New Customer'})
+                continue
+            (prediction, confidence), explanation = next(scored)
+            results.append({'customer_id': cust_id, 'prediction': prediction, 'probability': confidence,
+                            'explanation': explanation})
+        return jsonify({'model_version': model.version if model is not None else None, 'results': results})
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/portfolio/what-if', methods=['POST'])
+def portfolio_what_if():
+    """
+    Scores the whole portfolio under a grid of scenarios in one ML.PREDICT job.
+    Body: {"loan_amount_multipliers": [1.2], "loan_amounts": [30000],
+           "feature_multipliers": {"income": 0.9}, "thresholds": [0.3, 0.5],
+           "max_customers": 100}
+    """
+    try:
+        params = portfolio.parse_request(request.json or {})
+    except (ValueError, TypeError, AttributeError) as e:
+        return jsonify({'error': str(e)}), 400
+    try:
+        model = current_model() if params['max_customers'] > 0 else None
+        return jsonify(portfolio.run_what_if(get_bq_client(), PROJECT_ID, model=model, **params))
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+WARMUP_ON_START = os.environ.get('WARMUP_ON_START', '').lower() in ('1', 'true', 'yes')
+
+# Under gunicorn.conf.py the app is imported in the master, whose clients are
+# dropped at fork, so the warm-up runs in post_fork instead.
+if WARMUP_ON_START and 'gunicorn' not in sys.modules:
+    warm_up()
+
+STARTUP_STATS['import_ms'] = round((time.perf_counter() - _IMPORT_STARTED) * 1000, 2)
+logger.info(f"App module imported in {STARTUP_STATS['import_ms']:.1f} ms")
+
+# gunicorn workers are marked ready by the post_worker_init hook instead.
+if 'gunicorn' not in sys.modules:
+    mark_ready()
+
 if __name__ == "__main__":
     app.run(debug=True, host='0.0.0.0', port=int(os.environ.get('PORT', 8080)))
\ No newline at end of file
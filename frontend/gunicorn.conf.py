@@ -0,0 +1,87 @@
+# Production serving configuration (gunicorn --config gunicorn.conf.py app:app)
+#
+# Preforked workers sized to the CPU. Optionally the model coefficients (and
+# customer profiles) are loaded once in the master so every worker shares them.
+#   WEB_CONCURRENCY   worker processes (default: one per available CPU, i.e. the
+#                     cgroup CPU quota rounded up, capped by the CPU affinity)
+#   GUNICORN_THREADS  threads per worker (default: 8). A request that misses the
+#                     preloaded state spends most of its time waiting on
+#                     BigQuery, so each worker needs several in flight to keep
+#                     its CPU busy.
+#   PRELOAD_STATE     load serving state before fork (default: false)
+#   PRELOAD_PROFILES  include credit_history in that state (default: false)
+#
+# Preloading runs BigQuery jobs before any worker exists, and gunicorn has
+# already bound the port by then, so it lengthens every cold start. Leave it
+# off for scale-to-zero services. Turn it on for min-instance deployments with
+# an HTTP startup probe. PRELOAD_PROFILES costs ~100 bytes of (shared) memory
+# per customer.
+#
+# SERVING_STATE_PATH with ALLOW_UNVERIFIED_SNAPSHOT=true serves a fixed snapshot
+# (loadtest.py) without the ML.PREDICT parity check. Test use only.
+import gc
+import math
+import os
+
+def _cgroup_cpu_quota():
+    """CPUs allowed by the cgroup CPU quota (v2, then v1), or None if unlimited."""
+    try:
+        with open('/sys/fs/cgroup/cpu.max') as f:
+            quota, period = f.read().split()[:2]
+    except (OSError, ValueError):
+        try:
+            with open('/sys/fs/cgroup/cpu/cpu.cfs_quota_us') as f:
+                quota = f.read().strip()
+            with open('/sys/fs/cgroup/cpu/cpu.cfs_period_us') as f:
+                period = f.read().strip()
+        except OSError:
+            return None
+    if quota in ('max', '-1'):
+        return None
+    try:
+        return int(quota) / int(period)
+    except (ValueError, ZeroDivisionError):
+        return None
+
+def _available_cpus():
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+    # Affinity shows every host CPU inside a container; the quota is the real limit.
+    quota = _cgroup_cpu_quota()
+    if quota is not None:
+        cpus = min(cpus, max(1, math.ceil(quota)))
+    return cpus
+
+def _enabled(name, default='false'):
+    return os.environ.get(name, default).lower() in ('1', 'true', 'yes')
+
+bind = f":{os.environ.get('PORT', 8080)}"
+workers = int(os.environ.get('WEB_CONCURRENCY', _available_cpus()))
+threads = int(os.environ.get('GUNICORN_THREADS', 8))
+worker_class = 'gthread'
+timeout = 0
+
+# Import app.py in the master so its module state is inherited by the workers.
+preload_app = True
+
+def when_ready(server):
+    if _enabled('PRELOAD_STATE'):
+        import app
+        app.load_serving_state()
+    # Move everything allocated so far out of the GC's reach: collections in the
+    # workers would otherwise touch (and so copy) every shared page.
+    gc.collect()
+    gc.freeze()
+
+def post_fork(server, worker):
+    import app
+    app.reset_clients()
+    if app.WARMUP_ON_START:
+        app.warm_up()
+
+def post_worker_init(worker):
+    # Time from the master's start (the instance cold start) to this worker serving.
+    import app
+    app.mark_ready(worker.ppid)
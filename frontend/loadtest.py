@@ -0,0 +1,153 @@
+"""
+Load test for the production serving mode (gunicorn.conf.py).
+
+Starts gunicorn locally with 1..N workers against a synthetic serving-state
+snapshot (no GCP access needed: profiles and coefficients are preloaded, so
+/process-loan is pure CPU), drives it with concurrent keep-alive clients and
+reports throughput and speedup per worker count.
+
+The server and the load generators are pinned to disjoint CPU sets (by default
+the first and second half of the CPUs this process may use), so adding workers
+does not steal cores from the clients. With fewer than 2 CPUs they must share,
+and the numbers mostly measure contention.
+
+Usage: python loadtest.py [--server-cpus 0-3] [--client-cpus 4-7] [--duration SECONDS]
+"""
+import argparse
+import http.client
+import json
+import multiprocessing
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+
+import serving
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+def write_synthetic_snapshot(path, num_customers):
+    rng = random.Random(42)
+    serving.MODEL = serving.ModelState(-1.5, [0.002, -0.00002, 0.00001, -0.004, -0.005, 0.01, 0.02, 2.0])
+    serving.PROFILES = serving.ProfileStore(
+        (str(uuid.UUID(int=rng.getrandbits(128))), (
+            rng.randint(18, 70), rng.gauss(70000, 25000), rng.randint(300, 850), rng.randint(0, 120),
+            rng.randint(0, 15), round(rng.uniform(3.5, 25.0), 2), round(rng.uniform(0.1, 0.9), 2)))
+        for _ in range(num_customers)
+    )
+    serving.save_snapshot(path)
+    return [cid for cid, _ in serving.PROFILES.items()]
+
+def wait_for_port(port, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=1):
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"gunicorn did not start on port {port}")
+
+def parse_cpus(spec):
+    """'0-3,6' -> [0, 1, 2, 3, 6]"""
+    cpus = []
+    for part in spec.split(','):
+        first, _, last = part.partition('-')
+        cpus.extend(range(int(first), int(last or first) + 1))
+    return cpus
+
+def split_cpus(args):
+    available = sorted(os.sched_getaffinity(0))
+    if args.server_cpus or args.client_cpus:
+        server = parse_cpus(args.server_cpus) if args.server_cpus else available
+        client = parse_cpus(args.client_cpus) if args.client_cpus else [c for c in available if c not in server]
+        return server, client or server
+    if len(available) < 2:
+        return available, available
+    half = len(available) // 2
+    return available[:half], available[half:]
+
+def client_loop(args):
+    port, customer_ids, duration = args
+    rng = random.Random()
+    conn = http.client.HTTPConnection('127.0.0.1', port)
+    done = errors = 0
+    deadline = time.time() + duration
+    while time.time() < deadline:
+        body = json.dumps({'customer_id': rng.choice(customer_ids), 'loan_amount': rng.randint(5000, 50000)})
+        try:
+            conn.request('POST', '/process-loan', body, {'Content-Type': 'application/json'})
+            resp = conn.getresponse()
+            resp.read()
+            if resp.status == 200:
+                done += 1
+            else:
+                errors += 1
+        except (OSError, http.client.HTTPException):
+            errors += 1
+            conn.close()
+            conn = http.client.HTTPConnection('127.0.0.1', port)
+    conn.close()
+    return done, errors
+
+def run_level(workers, args, snapshot, customer_ids, server_cpus, client_cpus):
+    port = args.port
+    env = dict(os.environ, PROJECT_ID='loadtest', PORT=str(port), WEB_CONCURRENCY=str(workers),
+               GUNICORN_THREADS=str(args.threads), SERVING_STATE_PATH=snapshot, ALLOW_UNVERIFIED_SNAPSHOT='true',
+               PRELOAD_STATE='true')
+    # Workers inherit the master's affinity: one core per worker at each level.
+    server = subprocess.Popen([sys.executable, '-m', 'gunicorn', '--config', 'gunicorn.conf.py',
+                               '--log-level', 'warning', 'app:app'],
+                              cwd=HERE, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                              preexec_fn=lambda: os.sched_setaffinity(0, server_cpus[:workers]))
+    try:
+        wait_for_port(port)
+        time.sleep(0.5)  # let every worker finish booting
+        with multiprocessing.Pool(args.clients, initializer=os.sched_setaffinity,
+                                  initargs=(0, client_cpus)) as pool:
+            results = pool.map(client_loop, [(port, customer_ids, args.duration)] * args.clients)
+    finally:
+        server.terminate()
+        server.wait()
+    done = sum(r[0] for r in results)
+    errors = sum(r[1] for r in results)
+    return done / args.duration, errors
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--server-cpus', help='CPUs for gunicorn, e.g. 0-3 (default: first half)')
+    parser.add_argument('--client-cpus', help='CPUs for the load generators (default: the rest)')
+    parser.add_argument('--max-workers', type=int, default=None, help='Default: one per server CPU')
+    parser.add_argument('--threads', type=int, default=8, help='Threads per worker')
+    parser.add_argument('--clients', type=int, default=None, help='Concurrent client processes (default: 2 x client CPUs)')
+    parser.add_argument('--duration', type=float, default=10.0, help='Seconds per worker count')
+    parser.add_argument('--customers', type=int, default=5000, help='Synthetic profiles in the snapshot')
+    parser.add_argument('--port', type=int, default=8099)
+    args = parser.parse_args()
+    server_cpus, client_cpus = split_cpus(args)
+    args.max_workers = min(args.max_workers or len(server_cpus), len(server_cpus))
+    args.clients = args.clients or 2 * len(client_cpus)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        snapshot = os.path.join(tmp, 'serving_state.json')
+        customer_ids = write_synthetic_snapshot(snapshot, args.customers)
+
+        print(f"🔥 Load test: {args.clients} clients, {args.duration:.0f}s per level, {args.threads} threads/worker")
+        print(f"   - Server CPUs: {server_cpus} (worker count N is pinned to the first N)")
+        print(f"   - Client CPUs: {client_cpus}")
+        if set(server_cpus) & set(client_cpus):
+            print("   ⚠️  Server and clients share CPUs: results include client contention.")
+        print(f"   {'workers':>7}  {'req/s':>10}  {'speedup':>7}  {'errors':>6}")
+        baseline = None
+        for workers in range(1, args.max_workers + 1):
+            rps, errors = run_level(workers, args, snapshot, customer_ids, server_cpus, client_cpus)
+            baseline = baseline or rps
+            speedup = rps / baseline if baseline else 0.0
+            print(f"   {workers:>7}  {rps:>10.1f}  {speedup:>6.2f}x  {errors:>6}")
+
+if __name__ == "__main__":
+    main()
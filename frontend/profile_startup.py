@@ -0,0 +1,92 @@
+"""
+Cold-start profiler for the Cloud Run frontend.
+
+Imports app.py in a fresh interpreter (the same thing a new Cloud Run
+instance does) and reports:
+  - total import time, plus the slowest modules from `python -X importtime`
+  - process start to ready-to-serve
+  - first- and second-call latency of `/` (static) and of each --endpoint
+    (default: /list-applications, whose first call builds the Storage client),
+    served via the Flask test client
+  - optionally, the WARMUP_ON_START warm-up (client construction; needs GCP credentials)
+
+Without GCP credentials the GCP-backed endpoints fail fast, so their first
+call then measures the lazy imports and credential lookup, not the API call.
+
+Usage: python profile_startup.py [--top N] [--warmup] [--endpoint PATH ...]
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+PROBE = """
+import json, time
+started = time.perf_counter()
+import app
+import_ms = (time.perf_counter() - started) * 1000
+if WARMUP:
+    app.warm_up()
+client = app.app.test_client()
+calls = {}
+for path in ['/'] + ENDPOINTS:
+    timings = []
+    for _ in range(2):
+        started = time.perf_counter()
+        client.get(path)
+        timings.append(round((time.perf_counter() - started) * 1000, 2))
+    calls[path] = timings
+print(json.dumps({'import_ms': round(import_ms, 2), 'calls': calls,
+                  'app_stats': app.STARTUP_STATS}))
+"""
+
+def parse_importtime(stderr, top):
+    # Lines look like: "import time:  self [us] | cumulative | imported package"
+    rows = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'imported package' in line:
+            continue
+        _, self_us, cumulative_us, name = line.replace('import time:', '|', 1).split('|')
+        rows.append((int(cumulative_us), int(self_us), name[1:].rstrip()))
+    # Only top-level entries (no indentation) are attributable on their own.
+    top_level = [r for r in rows if not r[2].startswith(' ')]
+    return sorted(rows, reverse=True)[:top], sum(r[0] for r in top_level)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--top', type=int, default=15, help='Number of slowest imports to list')
+    parser.add_argument('--warmup', action='store_true', help='Also time the WARMUP_ON_START warm-up (builds GCP clients)')
+    parser.add_argument('--endpoint', action='append', dest='endpoints',
+                        help='GET endpoint whose first call to time (repeatable; default: /list-applications)')
+    args = parser.parse_args()
+    endpoints = args.endpoints or ['/list-applications']
+
+    env = dict(os.environ)
+    env.setdefault('PROJECT_ID', 'cold-start-profile')
+    code = f"WARMUP = {args.warmup}\nENDPOINTS = {endpoints!r}\n" + PROBE
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', code],
+                          cwd=HERE, env=env, capture_output=True, text=True)
+    if proc.returncode != 0:
+        print(proc.stderr, file=sys.stderr)
+        sys.exit(proc.returncode)
+
+    result = json.loads(proc.stdout.strip().splitlines()[-1])
+    slowest, total_us = parse_importtime(proc.stderr, args.top)
+
+    print("⏱️  Cold-Start Profile")
+    print(f"   - App import:        {result['import_ms']:.1f} ms")
+    print(f"   - Process start to ready: {result['app_stats']['ready_ms']:.1f} ms")
+    if args.warmup:
+        print(f"   - Warm-up (clients): {result['app_stats']['warmup_ms']:.1f} ms")
+    for path, (first_ms, second_ms) in result['calls'].items():
+        print(f"   - GET {path}: first call {first_ms:.1f} ms, then {second_ms:.1f} ms")
+    print(f"   - All imports (-X importtime): {total_us / 1000:.1f} ms")
+    print(f"\n   Slowest {len(slowest)} imports (cumulative ms):")
+    for cumulative_us, _, name in slowest:
+        print(f"   {cumulative_us / 1000:9.1f}  {name.strip()}")
+
+if __name__ == "__main__":
+    main()
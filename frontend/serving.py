@@ -0,0 +1,369 @@
+"""
+Production serving state for the Risk Engine.
+
+With PRELOAD_STATE / PRELOAD_PROFILES (see gunicorn.conf.py) this is loaded
+once in the gunicorn master and inherited by the forked workers:
+  - MODEL:    logistic regression coefficients (ML.WEIGHTS), feature means
+              (ML.FEATURE_INFO) and global attributions (ML.GLOBAL_EXPLAIN)
+  - PROFILES: a ProfileStore with the credit_history features
+
+MODEL is a handful of Python objects; a worker touching their refcounts
+copies a page or two, which is negligible. PROFILES is the part that scales
+with the portfolio, so it is packed into a few flat buffers (no per-row
+Python objects): lookups never write to those pages, and they stay shared
+copy-on-write across workers.
+
+ProfileCache is a small SQLite table on /dev/shm (tmpfs) that every worker on
+the host reads and writes, so a profile fetched from BigQuery by one worker is
+a cache hit for all the others.
+"""
+import json
+import logging
+import math
+import os
+import re
+import sqlite3
+import tempfile
+import threading
+import time
+from array import array
+
+logger = logging.getLogger(__name__)
+
+# Order matters: MODEL.weights and PROFILES rows are aligned to these.
+FEATURES = ('age', 'income', 'loan_amount', 'credit_score', 'months_employed',
+            'num_credit_lines', 'interest_rate', 'dti_ratio')
+PROFILE_FEATURES = tuple(f for f in FEATURES if f != 'loan_amount')
+LOAN_AMOUNT_INDEX = FEATURES.index('loan_amount')
+
+# BQML's default decision threshold for binary logistic regression.
+DECISION_THRESHOLD = 0.5
+
+# In-process scoring is only trusted once it reproduces ML.PREDICT on a sample
+# of real profiles to within this absolute probability difference.
+PARITY_SAMPLE = 20
+PARITY_TOLERANCE = 1e-6
+
+MODEL = None
+
+def feature_vector(profile, loan_amount):
+    """Splices the requested loan_amount into a PROFILE_FEATURES tuple (FEATURES order)."""
+    return profile[:LOAN_AMOUNT_INDEX] + (float(loan_amount),) + profile[LOAN_AMOUNT_INDEX:]
+
+def split_feature_vector(x):
+    """Inverse of feature_vector(): a FEATURES-ordered row -> (profile, loan_amount)."""
+    return tuple(x[:LOAN_AMOUNT_INDEX]) + tuple(x[LOAN_AMOUNT_INDEX + 1:]), x[LOAN_AMOUNT_INDEX]
+
+class ModelState:
+    """
+    Read-only logistic regression state for one model version: coefficients
+    (original feature scale) plus, when available, the training feature means
+    and cached ML.GLOBAL_EXPLAIN attributions. Scoring only needs the
+    coefficients; the explanation metadata is optional.
+
+    `verified` is set once the coefficients have reproduced ML.PREDICT. An
+    unverified state is still kept for its version and global attributions,
+    but must not score, and explain() returns None.
+    """
+    __slots__ = ('intercept', 'weights', 'means', 'global_attributions', 'version', 'verified')
+
+    def __init__(self, intercept, weights, means=None, global_attributions=None, version=None, verified=False):
+        self.intercept = float(intercept)
+        self.weights = tuple(float(w) for w in weights)
+        self.means = tuple(float(m) for m in means) if means is not None else None
+        self.global_attributions = dict(global_attributions) if global_attributions else None
+        self.version = version
+        self.verified = verified
+
+    def probability(self, profile, loan_amount):
+        """P(default), i.e. ML.PREDICT's probability for label 1."""
+        x = feature_vector(profile, loan_amount)
+        z = self.intercept + sum(w * v for w, v in zip(self.weights, x))
+        return 1.0 / (1.0 + math.exp(-z))
+
+    def score(self, profile, loan_amount):
+        """Returns (predicted_label, confidence) the same way ML.PREDICT does."""
+        prob_default = self.probability(profile, loan_amount)
+        if prob_default >= DECISION_THRESHOLD:
+            return 1, prob_default
+        return 0, 1.0 - prob_default
+
+    def explain(self, profile, loan_amount):
+        """
+        Per-decision attributions in log-odds of default: w * (x - training mean)
+        for each feature. baseline_log_odds (the average applicant) plus the
+        attributions adds up to the applicant's log-odds, so positive values
+        push towards rejection and negative values towards approval.
+        None when the coefficients are unverified or the feature means could
+        not be loaded.
+        """
+        if not self.verified or self.means is None:
+            return None
+        x = feature_vector(profile, loan_amount)
+        baseline = self.intercept + sum(w * m for w, m in zip(self.weights, self.means))
+        attributions = [{'feature': f, 'value': v, 'attribution': w * (v - m)}
+                        for f, w, v, m in zip(FEATURES, self.weights, x, self.means)]
+        attributions.sort(key=lambda a: abs(a['attribution']), reverse=True)
+        return {'baseline_log_odds': baseline, 'attributions': attributions}
+
+    def explain_batch(self, items):
+        """explain() over an iterable of (profile, loan_amount) pairs."""
+        return [self.explain(profile, loan_amount) for profile, loan_amount in items]
+
+    def global_explanation(self):
+        if self.global_attributions is None:
+            return None
+        ranked = sorted(self.global_attributions.items(), key=lambda kv: abs(kv[1]), reverse=True)
+        return {'model_version': self.version,
+                'attributions': [{'feature': f, 'attribution': a} for f, a in ranked]}
+
+    def to_dict(self):
+        return {'intercept': self.intercept, 'weights': dict(zip(FEATURES, self.weights)),
+                'means': dict(zip(FEATURES, self.means)) if self.means is not None else None,
+                'global_attributions': self.global_attributions, 'version': self.version}
+
+    @classmethod
+    def from_dict(cls, data):
+        means = data.get('means')
+        return cls(data['intercept'], [data['weights'][f] for f in FEATURES],
+                   [means[f] for f in FEATURES] if means else None,
+                   data.get('global_attributions'), data.get('version'))
+
+class ProfileStore:
+    """
+    Read-only, packed customer profiles. Customer ids are sorted into one bytes
+    blob (plus an array of offsets) and the features into one array('d'), so a
+    million customers cost ~100 MB in three buffers instead of millions of
+    dicts, strings and floats. get() is a binary search that only reads them.
+    """
+
+    def __init__(self, rows=(), version=None):
+        rows = sorted((str(cid).encode(), features) for cid, features in rows)
+        offsets, position = array('q', [0]), 0
+        for cid, _ in rows:
+            position += len(cid)
+            offsets.append(position)
+        self._ids = b''.join(cid for cid, _ in rows)
+        self._offsets = offsets
+        self._features = array('d', (float(x) for _, features in rows for x in features))
+        self.version = version
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def _id_at(self, i):
+        return self._ids[self._offsets[i]:self._offsets[i + 1]]
+
+    def get(self, customer_id):
+        """Feature tuple (PROFILE_FEATURES order) or None."""
+        key = customer_id.encode()
+        lo, hi = 0, len(self)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._id_at(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < len(self) and self._id_at(lo) == key:
+            n = len(PROFILE_FEATURES)
+            return tuple(self._features[lo * n:(lo + 1) * n])
+        return None
+
+    def items(self):
+        n = len(PROFILE_FEATURES)
+        for i in range(len(self)):
+            yield self._id_at(i).decode(), tuple(self._features[i * n:(i + 1) * n])
+
+PROFILES = ProfileStore()
+
+# =======================================================
+# LOADING (runs in the gunicorn master, before fork)
+# =======================================================
+def fetch_model_version(bq_client, project_id):
+    """Cheap metadata call (no query job) that changes whenever the model is retrained."""
+    model = bq_client.get_model(f"{project_id}.credit_risk_mvp.risk_score_model")
+    return model.etag or str(model.modified)
+
+class ParityError(ValueError):
+    """Local coefficients do not reproduce ML.PREDICT."""
+
+def fetch_model_state(bq_client, project_id, version):
+    """
+    State for `version`. The coefficients are checked against ML.PREDICT on
+    PARITY_SAMPLE profiles and the state is only marked verified if they
+    match; a failed check is logged, and the unverified state still carries
+    the version and the global attributions. Explanation metadata is loaded
+    on a best-effort basis: if it fails the state still scores, it just
+    cannot explain.
+    """
+    # With the default STRUCT(FALSE AS standardize), ML.WEIGHTS reports the
+    # weights against the raw (unstandardized) inputs, so they apply directly
+    # to profile values. For binary LOGISTIC_REG they score the positive
+    # label (1 = default). The parity check below is what confirms this.
+    model = f"`{project_id}.credit_risk_mvp.risk_score_model`"
+    # Submit every job before waiting on any of them.
+    weights_job = bq_client.query(f"SELECT processed_input, weight FROM ML.WEIGHTS(MODEL {model})")
+    parity_job = bq_client.query(f"""
+        SELECT {', '.join(FEATURES)},
+               (SELECT prob FROM UNNEST(predicted_label_probs) WHERE label = 1) AS prob
+        FROM ML.PREDICT(MODEL {model}, (
+            SELECT {', '.join(FEATURES)}
+            FROM `{project_id}.credit_risk_mvp.credit_history`
+            LIMIT {PARITY_SAMPLE}))
+    """)
+    info_job = bq_client.query(f"SELECT input, mean FROM ML.FEATURE_INFO(MODEL {model})")
+    explain_job = bq_client.query(f"SELECT feature, attribution FROM ML.GLOBAL_EXPLAIN(MODEL {model})")
+
+    weights = {row.processed_input: row.weight for row in weights_job.result()}
+    state = ModelState(weights.pop('__INTERCEPT__'), [weights[f] for f in FEATURES], version=version)
+    try:
+        check_parity(state, parity_job.result())
+        state.verified = True
+    except ParityError as e:
+        logger.error(f"Model {version}: {e} Decisions and explanations stay on ML.PREDICT for this version.")
+
+    try:
+        means = {row.input: row.mean for row in info_job.result()}
+        state.means = tuple(float(means[f]) for f in FEATURES)
+    except Exception as e:
+        logger.warning(f"ML.FEATURE_INFO unavailable, per-decision explanations disabled: {e}")
+    try:
+        state.global_attributions = {row.feature: row.attribution for row in explain_job.result()}
+    except Exception as e:
+        logger.warning(f"ML.GLOBAL_EXPLAIN unavailable, global explanation disabled: {e}")
+    return state
+
+def check_parity(state, predict_rows):
+    """Raises ParityError unless `state` reproduces ML.PREDICT's P(default) on every row."""
+    worst, checked = 0.0, 0
+    for row in predict_rows:
+        profile, loan_amount = split_feature_vector([float(row[f]) for f in FEATURES])
+        worst = max(worst, abs(state.probability(profile, loan_amount) - row['prob']))
+        checked += 1
+    if not checked:
+        raise ParityError("No rows available to check parity against ML.PREDICT.")
+    if worst > PARITY_TOLERANCE:
+        raise ParityError(f"Local scoring differs from ML.PREDICT by up to {worst:.2e} "
+                          f"(tolerance {PARITY_TOLERANCE:.0e}).")
+    logger.info(f"Model {state.version}: local scoring matches ML.PREDICT on {checked} rows "
+                f"(max difference {worst:.2e})")
+
+def fetch_profiles_version(bq_client, project_id):
+    """Metadata call that changes whenever credit_history is written to."""
+    table = bq_client.get_table(f"{project_id}.credit_risk_mvp.credit_history")
+    return table.etag or str(table.modified)
+
+def fetch_profiles(bq_client, project_id):
+    version = fetch_profiles_version(bq_client, project_id)
+    query = f"""
+        SELECT customer_id, {', '.join(PROFILE_FEATURES)}
+        FROM `{project_id}.credit_risk_mvp.credit_history`
+    """
+    rows = bq_client.query(query).result(page_size=50000)
+    return ProfileStore(((row.customer_id, [row[f] for f in PROFILE_FEATURES]) for row in rows), version)
+
+def load_state(bq_client, project_id, include_profiles=False):
+    """Populates MODEL (and PROFILES) from BigQuery. Failures leave the app on the ML.PREDICT path."""
+    global MODEL, PROFILES
+    started = time.perf_counter()
+    try:
+        MODEL = fetch_model_state(bq_client, project_id, fetch_model_version(bq_client, project_id))
+        if include_profiles:
+            PROFILES = fetch_profiles(bq_client, project_id)
+    except Exception as e:
+        logger.warning(f"Serving state not loaded, falling back to BigQuery per request: {e}")
+        return False
+    logger.info(f"Serving state loaded in {(time.perf_counter() - started) * 1000:.1f} ms "
+                f"({len(PROFILES)} profiles)")
+    return True
+
+def save_snapshot(path):
+    with open(path, 'w') as f:
+        json.dump({'model': MODEL.to_dict(), 'features': PROFILE_FEATURES,
+                   'profiles': {k: list(v) for k, v in PROFILES.items()}}, f)
+
+def load_snapshot(path):
+    """
+    Loads state from a save_snapshot() file instead of BigQuery (offline runs,
+    load tests). The coefficients are trusted as-is: there is no ML.PREDICT
+    to check them against.
+    """
+    global MODEL, PROFILES
+    with open(path) as f:
+        data = json.load(f)
+    MODEL = ModelState.from_dict(data['model'])
+    MODEL.verified = True
+    PROFILES = ProfileStore(data['profiles'].items())
+    logger.info(f"Serving state loaded from {path} ({len(PROFILES)} profiles)")
+
+def profile_to_dict(profile):
+    return dict(zip(PROFILE_FEATURES, profile))
+
+# =======================================================
+# CROSS-WORKER PROFILE CACHE
+# =======================================================
+def _default_cache_path(namespace):
+    shm = '/dev/shm'
+    base = shm if os.path.isdir(shm) and os.access(shm, os.W_OK) else tempfile.gettempdir()
+    return os.path.join(base, f"risk-engine-cache-{re.sub(r'[^A-Za-z0-9_.-]', '_', namespace)}.sqlite")
+
+class ProfileCache:
+    """
+    Host-wide profile cache shared by all workers (SQLite on tmpfs). It is a
+    best-effort cache: any SQLite error is logged and treated as a miss. Every
+    PRUNE_EVERY writes, expired rows are deleted and the table is trimmed to
+    max_rows, since a tmpfs file counts against instance memory.
+    """
+    PRUNE_EVERY = 100
+
+    def __init__(self, namespace, path=None, ttl_seconds=300, max_rows=100000):
+        self.path = path or _default_cache_path(namespace)
+        self.ttl_seconds = ttl_seconds
+        self.max_rows = max_rows
+        self._local = threading.local()
+        self._writes = 0
+
+    def _conn(self):
+        # One connection per thread, opened lazily so nothing crosses a fork.
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=OFF')
+            conn.execute('CREATE TABLE IF NOT EXISTS profiles '
+                         '(customer_id TEXT PRIMARY KEY, features TEXT, expires_at REAL)')
+            conn.execute('CREATE INDEX IF NOT EXISTS profiles_expires_at ON profiles (expires_at)')
+            self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+
+    def get(self, customer_id):
+        """Returns the cached feature tuple (None = known net-new customer); raises KeyError if not cached."""
+        try:
+            row = self._conn().execute('SELECT features, expires_at FROM profiles WHERE customer_id = ?',
+                                       (customer_id,)).fetchone()
+        except sqlite3.Error as e:
+            logger.warning(f"Profile cache read failed, treating as a miss: {e}")
+            raise KeyError(customer_id)
+        if row is None or row[1] < time.time():
+            raise KeyError(customer_id)
+        features = json.loads(row[0])
+        return tuple(features) if features is not None else None
+
+    def set(self, customer_id, features):
+        try:
+            conn = self._conn()
+            conn.execute('INSERT OR REPLACE INTO profiles VALUES (?, ?, ?)',
+                         (customer_id, json.dumps(features), time.time() + self.ttl_seconds))
+            self._writes += 1
+            if self._writes % self.PRUNE_EVERY == 0:
+                self.prune(conn)
+        except sqlite3.Error as e:
+            logger.warning(f"Profile cache write failed: {e}")
+
+    def prune(self, conn=None):
+        conn = conn or self._conn()
+        conn.execute('DELETE FROM profiles WHERE expires_at < ?', (time.time(),))
+        excess = conn.execute('SELECT COUNT(*) FROM profiles').fetchone()[0] - self.max_rows
+        if excess > 0:
+            conn.execute('DELETE FROM profiles WHERE customer_id IN '
+                         '(SELECT customer_id FROM profiles ORDER BY expires_at LIMIT ?)', (excess,))
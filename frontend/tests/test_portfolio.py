@@ -0,0 +1,106 @@
+import math
+
+import pytest
+
+import portfolio
+
+
+def row(scenario_id, bucket, customers, approved, prob_sum=0.0, flipped_to_rejected=0, flipped_to_approved=0):
+    r = {'scenario_id': scenario_id, 'bucket': bucket, 'customers': customers, 'prob_sum': prob_sum,
+         'flipped_to_rejected': flipped_to_rejected, 'flipped_to_approved': flipped_to_approved}
+    r.update({f'approved_{k}': count for k, count in enumerate(approved)})
+    return r
+
+
+# ===== build_scenarios =====
+
+def test_build_scenarios_baseline_first_and_amounts_sorted():
+    scenarios = portfolio.build_scenarios({'loan_amounts': [30000, 10000], 'loan_amount_multipliers': [1.2]})
+    assert scenarios[0] == portfolio.BASELINE
+    assert [s.get('loan_amount') for s in scenarios[1:3]] == [10000.0, 30000.0]
+    assert scenarios[3]['loan_amount_multiplier'] == 1.2
+
+
+def test_build_scenarios_applies_feature_multipliers_to_every_scenario():
+    scenarios = portfolio.build_scenarios({'loan_amounts': [1000, 2000], 'feature_multipliers': {'income': 0.9}})
+    assert all(s['income_multiplier'] == 0.9 for s in scenarios[1:])
+    assert 'income_multiplier' not in scenarios[0]
+
+
+def test_build_scenarios_feature_multipliers_alone():
+    scenarios = portfolio.build_scenarios({'feature_multipliers': {'income': 0.9}})
+    assert len(scenarios) == 2 and scenarios[1]['income_multiplier'] == 0.9
+
+
+@pytest.mark.parametrize('req', [
+    {},
+    {'feature_multipliers': {'loan_amount': 2}},
+    {'feature_multipliers': {'shoe_size': 2}},
+    {'loan_amounts': [-1]},
+    {'loan_amounts': [float('nan')]},
+    {'loan_amount_multipliers': [float('inf')]},
+    {'loan_amounts': list(range(portfolio.MAX_SCENARIOS))},
+])
+def test_build_scenarios_rejects(req):
+    with pytest.raises(ValueError):
+        portfolio.build_scenarios(req)
+
+
+# ===== parse_request =====
+
+def test_parse_request_defaults():
+    params = portfolio.parse_request({'loan_amounts': [5000]})
+    assert params['thresholds'] == list(portfolio.DEFAULT_THRESHOLDS)
+    assert params['threshold'] == portfolio.DECISION_THRESHOLD
+    assert params['max_customers'] == 0
+
+
+@pytest.mark.parametrize('extra', [
+    {'thresholds': [1.5]},
+    {'thresholds': [float('nan')]},
+    {'decision_threshold': -0.1},
+    {'max_customers': portfolio.MAX_FLIPPED_CUSTOMERS + 1},
+    {'max_customers': float('inf')},
+])
+def test_parse_request_rejects(extra):
+    with pytest.raises(ValueError):
+        portfolio.parse_request({'loan_amounts': [5000], **extra})
+
+
+# ===== summarize =====
+
+def test_summarize_uses_exact_threshold_counts():
+    scenarios = [dict(portfolio.BASELINE), {'label': 'x'}]
+    # approved_0 is the decision threshold, approved_1.. the requested thresholds.
+    rows = [
+        row(0, 0, 3, [3, 3, 3], prob_sum=0.03),
+        row(0, 9, 1, [1, 0, 1], prob_sum=0.49),  # 0.49: approved at 0.5, not at 0.45
+        row(1, 10, 4, [0, 0, 4], prob_sum=2.4, flipped_to_rejected=3),
+    ]
+    baseline, scenario = portfolio.summarize(rows, scenarios, thresholds=[0.45, 0.7], threshold=0.5)
+
+    assert baseline['customers'] == 4
+    assert baseline['approval_rate'] == 1.0
+    assert [t['approval_rate'] for t in baseline['threshold_sensitivity']] == [0.75, 1.0]
+    assert math.isclose(baseline['mean_default_probability'], 0.13)
+    assert baseline['default_probability_histogram'][0] == 3
+    assert baseline['default_probability_histogram'][9] == 1
+    assert sum(baseline['default_probability_histogram']) == 4
+
+    assert scenario['approval_rate'] == 0.0
+    assert scenario['flipped_to_rejected'] == 3
+    assert [t['threshold'] for t in scenario['threshold_sensitivity']] == [0.45, 0.7]
+
+
+def test_summarize_empty_scenario():
+    (result,) = portfolio.summarize([], [dict(portfolio.BASELINE)], thresholds=[0.5])
+    assert result['customers'] == 0
+    assert result['approval_rate'] == 0.0
+    assert result['threshold_sensitivity'] == [{'threshold': 0.5, 'approval_rate': 0.0}]
+
+
+def test_histogram_query_has_one_count_per_threshold():
+    sql = portfolio.build_histogram_query('p', [dict(portfolio.BASELINE)], thresholds=[0.3, 0.7], threshold=0.5)
+    assert 'COUNTIF(s.prob < 0.5) AS approved_0' in sql
+    assert 'COUNTIF(s.prob < 0.3) AS approved_1' in sql
+    assert 'COUNTIF(s.prob < 0.7) AS approved_2' in sql
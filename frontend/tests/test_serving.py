@@ -0,0 +1,137 @@
+import pytest
+
+import serving
+
+
+def profile(seed):
+    return tuple(float(seed * 10 + k) for k in range(len(serving.PROFILE_FEATURES)))
+
+
+# ===== ProfileStore =====
+
+def test_profile_store_get_hits_and_misses():
+    ids = ['c-42', 'a-1', 'b-7', 'ü-9', 'a-10']
+    store = serving.ProfileStore((cid, profile(i)) for i, cid in enumerate(ids))
+    assert len(store) == len(ids)
+    for i, cid in enumerate(ids):
+        assert store.get(cid) == profile(i)
+    for missing in ('', 'a', 'a-100', 'b-6', 'zzz'):
+        assert store.get(missing) is None
+
+
+def test_profile_store_items_sorted():
+    store = serving.ProfileStore([('b', profile(1)), ('a', profile(0))], version='v1')
+    assert list(store.items()) == [('a', profile(0)), ('b', profile(1))]
+    assert store.version == 'v1'
+
+
+def test_empty_profile_store():
+    store = serving.ProfileStore()
+    assert len(store) == 0
+    assert store.get('anyone') is None
+    assert list(store.items()) == []
+
+
+# ===== ProfileCache =====
+
+def test_profile_cache_round_trip(tmp_path):
+    cache = serving.ProfileCache('test', path=str(tmp_path / 'cache.sqlite'))
+    with pytest.raises(KeyError):
+        cache.get('c1')
+    cache.set('c1', profile(1))
+    cache.set('new', None)
+    assert cache.get('c1') == profile(1)
+    assert cache.get('new') is None
+
+
+def test_profile_cache_expiry_and_cap(tmp_path):
+    cache = serving.ProfileCache('test', path=str(tmp_path / 'cache.sqlite'), ttl_seconds=-1)
+    cache.set('c1', profile(1))
+    with pytest.raises(KeyError):
+        cache.get('c1')
+
+    cache = serving.ProfileCache('test', path=str(tmp_path / 'capped.sqlite'), max_rows=3)
+    for i in range(5):
+        cache.set(f'c{i}', profile(i))
+    cache.prune()
+    count = cache._conn().execute('SELECT COUNT(*) FROM profiles').fetchone()[0]
+    assert count == 3
+
+
+# ===== Parity check =====
+
+class Row(dict):
+    """Stands in for a BigQuery Row: item and attribute access."""
+    __getattr__ = dict.__getitem__
+
+
+class FakeJob:
+    def __init__(self, rows):
+        self.rows = rows
+
+    def result(self, **kwargs):
+        return iter(self.rows)
+
+
+class FakeClient:
+    """Answers the fetch_model_state() queries from a known set of coefficients."""
+
+    def __init__(self, state, predict_rows):
+        self.state = state
+        self.predict_rows = predict_rows
+
+    def query(self, sql, **kwargs):
+        if 'ML.WEIGHTS' in sql:
+            return FakeJob([Row(processed_input='__INTERCEPT__', weight=self.state.intercept)] +
+                           [Row(processed_input=f, weight=w) for f, w in zip(serving.FEATURES, self.state.weights)])
+        if 'ML.PREDICT' in sql:
+            return FakeJob(self.predict_rows)
+        if 'ML.FEATURE_INFO' in sql:
+            return FakeJob([Row(input=f, mean=1.0) for f in serving.FEATURES])
+        if 'ML.GLOBAL_EXPLAIN' in sql:
+            return FakeJob([Row(feature='credit_score', attribution=0.4)])
+        raise AssertionError(sql)
+
+
+STATE = serving.ModelState(-1.5, [0.02, -0.00001, 0.00003, -0.004, -0.005, 0.05, 0.08, 2.0], version='v1')
+
+
+def predict_rows(state, n=5):
+    rows = []
+    for i in range(n):
+        x = (30 + i, 50000.0 + 1000 * i, 15000.0, 600 + 10 * i, 24, 5, 9.5, 0.3)
+        profile, loan_amount = serving.split_feature_vector(x)
+        rows.append(Row(zip(serving.FEATURES, x), prob=state.probability(profile, loan_amount)))
+    return rows
+
+
+def test_check_parity_passes_on_matching_predictions():
+    serving.check_parity(STATE, predict_rows(STATE))
+
+
+def test_check_parity_fails_on_mismatch():
+    rows = predict_rows(STATE)
+    rows[2]['prob'] += 10 * serving.PARITY_TOLERANCE
+    with pytest.raises(serving.ParityError):
+        serving.check_parity(STATE, rows)
+
+
+def test_check_parity_fails_without_rows():
+    with pytest.raises(serving.ParityError):
+        serving.check_parity(STATE, [])
+
+
+def test_fetch_model_state_verified():
+    state = serving.fetch_model_state(FakeClient(STATE, predict_rows(STATE)), 'p', 'v1')
+    assert state.verified
+    assert state.weights == STATE.weights
+    assert state.explain(profile(1), 10000.0) is not None
+
+
+def test_fetch_model_state_keeps_unverified_state_on_parity_failure():
+    other = serving.ModelState(0.5, STATE.weights)
+    state = serving.fetch_model_state(FakeClient(STATE, predict_rows(other)), 'p', 'v2')
+    assert not state.verified
+    assert state.version == 'v2'
+    assert state.explain(profile(1), 10000.0) is None
+    assert state.global_explanation()['attributions'] == [{'feature': 'credit_score', 'attribution': 0.4}]